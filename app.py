@@ -4,19 +4,26 @@ Isolated Fast Streaming Server for Railway - Solves Video Switching and Slow Loa
 Complete isolation system prevents old video playback + fast 1MB chunk streaming
 Production-ready version for Railway.app deployment
 """
-from flask import Flask, Response, request, redirect, jsonify
+from flask import Flask, Response, request, redirect, jsonify, send_from_directory
 import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
 import threading
+import multiprocessing
 import time
 import os
 import hashlib
 import logging
 from datetime import datetime, timedelta
-from urllib.parse import unquote
+from urllib.parse import unquote, urlsplit
 import subprocess
 import signal
+import select
+import socket
 import sys
-import gc
+import re
+import gzip
+from collections import OrderedDict
 
 # Configure logging for production
 logging.basicConfig(
@@ -28,321 +35,674 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
+# Static assets are served by static_files() below with long-lived caching
+app = Flask(__name__, static_folder=None)
 app.secret_key = os.environ.get("SESSION_SECRET", "fallback-secret-key-for-development")
+# Video state lives in shared memory below, never in the signed session cookie
+app.config['SESSION_REFRESH_EACH_REQUEST'] = False
 
 # ISOLATED STREAMING CONFIGURATION
 FAST_CHUNK_SIZE = 1024 * 1024  # 1MB chunks for instant loading
 STANDARD_CHUNK_SIZE = 512 * 1024  # 512KB chunks for standard streaming
 INITIAL_BUFFER_SIZE = 2 * 1024 * 1024  # 2MB initial buffer for immediate playback
+SESSION_IDLE_TTL = 3600  # Isolated sessions unused this long are closed by cleanup_sessions()
+MAX_VIDEO_SESSIONS = 8  # Oldest isolated sessions are evicted beyond this
+NETWORK_EWMA_ALPHA = 0.3  # Weight of a NETWORK_SAMPLE_BYTES bandwidth sample
+NETWORK_SAMPLE_BYTES = 512 * 1024  # Delivered bytes that make up one full-weight sample
+NETWORK_MIN_SAMPLES = 8  # Full samples' worth of delivered bytes measured before chunk sizes adapt
+MIN_CHUNK_SIZE = 64 * 1024  # Floor for bandwidth-adaptive chunks
+MAX_CHUNK_SIZE = 4 * 1024 * 1024  # Ceiling for bandwidth-adaptive chunks
+CHUNK_TARGET_LATENCY_MS = 500  # Each adaptive chunk carries this much transfer time
+MAX_SINGLE_RANGE = 16 * 1024 * 1024  # Largest span served for one range request
+STREAM_READ_SIZE = 64 * 1024  # Upstream read granularity while filling one chunk
+STREAM_FLUSH_INTERVAL = 0.002  # Partial chunks are flushed once upstream sends nothing for this long
+STATIC_MAX_AGE = 31536000  # One year - asset URLs carry a ?v= version to bust caches
+UPSTREAM_META_TTL = 60  # Seconds upstream headers answer repeated HEAD probes
+UPSTREAM_META_MAX = 512  # Video URLs whose upstream headers are remembered
+HEAD_CACHE_CONTROL = 'public, max-age=30, stale-while-revalidate=60'  # HEADs for an explicit ?url=
+PAGE_GZIP_LEVEL = 6  # Dashboard pages are a few KB; higher levels cost time and save little
+
+_RANGE_RE = re.compile(r'bytes=(\d+)-(\d*)$')
+# User-Agent matchers compiled once: MX Player itself, and any MX/Android/mobile player
+# (ExoPlayer-based apps do not always say Android)
+_MX_PLAYER_RE = re.compile(r'mx\s?player', re.I)
+_MOBILE_PLAYER_RE = re.compile(r'mx\s?player|exoplayer|android|mobile', re.I)
+
+# Static MX Player response headers - copied per request, Content-Type filled in
+_MX_HEAD_HEADERS = {
+    'Accept-Ranges': 'bytes',
+    'Connection': 'keep-alive',
+    'X-MX-Player-Compatible': 'true',
+    'X-Android-Compatible': 'true',
+    'Access-Control-Allow-Origin': '*',
+    'Content-Disposition': 'inline; filename="video.mp4"'
+}
+_MX_STREAM_HEADERS = {
+    **_MX_HEAD_HEADERS,
+    'X-Video-Direct-Stream': 'true',
+    'Cache-Control': 'no-cache'
+}
+# Upstream request headers shared by every session; per request only the
+# fields that vary (User-Agent, Referer, Range, manifest encodings) are sent
+_UPSTREAM_SESSION_HEADERS = {
+    'Accept': '*/*',
+    'Accept-Encoding': 'identity',
+    'Connection': 'keep-alive'
+}
+# Upstream request headers that make the origin treat the proxy as MX Player
+_MX_UPSTREAM_HEADERS = {
+    'User-Agent': 'MXPlayer/1.46.15 (Android)',
+    'Accept': 'video/mp4,video/*,*/*',
+    'Accept-Language': 'en-US,en;q=0.9',
+    'Cache-Control': 'no-cache',
+    'Pragma': 'no-cache'
+}
+# Static /video response headers - copied per request, dynamic fields filled in
+_STREAM_CORS_HEADERS = {
+    'Accept-Ranges': 'bytes',
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, HEAD, OPTIONS',
+    'Access-Control-Allow-Headers': 'Range, Content-Type, Authorization, User-Agent',
+    'Access-Control-Expose-Headers': 'Content-Length, Content-Range, Accept-Ranges',
+    'X-Content-Type-Options': 'nosniff',
+    'Connection': 'keep-alive',
+    'Server': 'nginx/1.18.0'
+}
+_STREAM_HEAD_HEADERS = {
+    **_STREAM_CORS_HEADERS,
+    'Cache-Control': 'no-cache'
+}
+_STREAM_HEAD_MX_HEADERS = {
+    'X-MX-Player-Compatible': 'true',
+    'Transfer-Encoding': 'identity',
+    'X-Android-Compatible': 'true',
+    'X-Video-Direct-Stream': 'true',
+    'Vary': 'Accept-Encoding',
+    'Content-Security-Policy': 'default-src *'
+}
+_STREAM_GET_HEADERS = {
+    **_STREAM_CORS_HEADERS,
+    'Cache-Control': 'no-cache, no-store, must-revalidate',
+    'Pragma': 'no-cache',
+    'Expires': '0',
+    'Content-Disposition': 'inline; filename="video.mp4"',
+    'Transfer-Encoding': 'identity',
+    'X-Frame-Options': 'SAMEORIGIN',
+    'Vary': 'Accept-Encoding'
+}
+_STREAM_GET_MX_HEADERS = {
+    'X-MX-Player-Compatible': 'true',
+    'X-Android-Compatible': 'true',
+    'X-Video-Direct-Stream': 'true',
+    'Content-Security-Policy': 'default-src *'
+}
+# Upstream headers passed through to the client unchanged
+_PASSTHROUGH_HEADERS = ('Content-Length', 'Content-Range', 'Last-Modified', 'ETag', 'Content-Encoding')
+# Text manifests compress well; everything else is already-compressed media
+_MANIFEST_EXTENSIONS = frozenset({'m3u8', 'mpd'})
+# Replit deployments are only reachable over https
+_REPLIT_HOSTS = ('replit.dev', 'replit.app')
+
+UPSTREAM_POOL_CONNECTIONS = 64  # Upstream hosts kept in each session's pool
+UPSTREAM_POOL_MAXSIZE = 256  # Keep-alive connections kept per upstream host
+
+def new_upstream_session(headers=None):
+    """Create a requests session with a large keep-alive pool to the video origin"""
+    session_obj = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=UPSTREAM_POOL_CONNECTIONS,
+        pool_maxsize=UPSTREAM_POOL_MAXSIZE,
+        max_retries=0
+    )
+    session_obj.mount('https://', adapter)
+    session_obj.mount('http://', adapter)
+    # No proxy/netrc environment lookups on every request
+    session_obj.trust_env = False
+    # Constant upstream headers live on the session, which merges them into every request
+    session_obj.headers.update(_UPSTREAM_SESSION_HEADERS)
+    if headers:
+        session_obj.headers.update(headers)
+    return session_obj
+
+# Shared keep-alive pool for MX Player and ?url= fallback streams - reuses upstream TCP/TLS connections
+UPSTREAM_SESSION = new_upstream_session({
+    'Cache-Control': 'no-cache',
+    'Pragma': 'no-cache'
+})
+
+# Referers the video origin accepts; the fallback is retried once on 403
+ORIGIN_REFERER = 'https://moviebox.ng/'
+FALLBACK_REFERER = 'https://valiw.hakunaymatata.com/'
+MAX_REFERER_HOSTS = 256  # Hosts whose working Referer is remembered
+# Host -> Referer that last worked, least recently used first, so the 403 retry happens once per host
+_host_referers = OrderedDict()
+_host_referers_lock = threading.Lock()
+
+def referer_for(video_url):
+    """Referer to send on the first attempt for this URL's host"""
+    host = urlsplit(video_url).netloc
+    with _host_referers_lock:
+        referer = _host_referers.get(host)
+        if referer is None:
+            return ORIGIN_REFERER
+        _host_referers.move_to_end(host)
+        return referer
+
+def remember_referer(video_url, referer):
+    """Send this Referer first for the URL's host from now on, forgetting the least recent host beyond MAX_REFERER_HOSTS"""
+    host = urlsplit(video_url).netloc
+    with _host_referers_lock:
+        _host_referers[host] = referer
+        _host_referers.move_to_end(host)
+        while len(_host_referers) > MAX_REFERER_HOSTS:
+            _host_referers.popitem(last=False)
+
+def prewarm_upstream(session_obj, video_url):
+    """Open a keep-alive connection to the origin in the background so the first stream skips TCP/TLS setup"""
+    def warm():
+        try:
+            session_obj.head(video_url, headers={'Referer': referer_for(video_url)}, timeout=10).close()
+        except requests.exceptions.RequestException as e:
+            logger.info(f"Upstream pre-warm failed: {e}")
+    threading.Thread(target=warm, daemon=True).start()
+
+# Dashboard templates are compiled once at import and rendered per request
+_HOME_TMPL = app.jinja_env.get_template('home.html')
+_SET_VIDEO_TMPL = app.jinja_env.get_template('set_video.html')
+_TEST_ISOLATION_TMPL = app.jinja_env.get_template('test_isolation.html')
+
+def render_page(template, **context):
+    """Render a dashboard page, gzipped when the client accepts it"""
+    html = template.render(**context)
+    headers = {'Vary': 'Accept-Encoding'}
+    if 'gzip' not in request.headers.get('Accept-Encoding', ''):
+        return Response(html, headers=headers, mimetype='text/html')
+    body = gzip.compress(html.encode('utf-8'), PAGE_GZIP_LEVEL, mtime=0)
+    headers['Content-Encoding'] = 'gzip'
+    return Response(body, headers=headers, mimetype='text/html')
 
 # ISOLATION VARIABLES - Each video gets completely separate session
-# Using Flask session to maintain state across workers
-import json
-from flask import session
+# Current video state lives in shared memory created before gunicorn forks
+# (preload_app), so every worker sees /set-video without a signed cookie.
+# Readers never lock: a seqlock version, odd while a write is in progress,
+# tells them to re-read. Only /set-video writers take the lock
+MAX_VIDEO_URL_BYTES = 16384
+STATE_LOCK_TIMEOUT = 1.0  # Seconds a writer waits before assuming the lock holder died
+STATE_READ_RETRIES = 1000  # Re-reads of a torn state before taking it as-is
+_current_state_lock = multiprocessing.Lock()
+_current_state_version = multiprocessing.RawValue('L', 0)
+_current_url = multiprocessing.RawArray('c', MAX_VIDEO_URL_BYTES)
+_current_video_id = multiprocessing.RawArray('c', 64)
+_cache_buster = multiprocessing.RawValue('i', 0)
 
 # No default video URL - User must provide video URL
 DEFAULT_VIDEO_URL = None
 
-# Worker-local session storage
-video_sessions = {}  # Isolated sessions per video
-video_metadata = {}  # Metadata per video
+# Worker-local session storage - ordered least recently used first
+video_sessions = OrderedDict()  # Isolated sessions per video
+video_metadata = OrderedDict()  # Metadata per video
 server_running = True
+_sessions_lock = threading.Lock()  # Guards video_sessions/video_metadata across greenlets and threads
+_sessions_changed = threading.Condition(_sessions_lock)  # Wakes cleanup_sessions() when a session is stored
+_bw_ewma = 0.0  # Smoothed delivery bandwidth of real streams in KB/s
+_bw_samples = 0.0  # Full samples' worth of bytes folded into _bw_ewma so far
+
+def store_video_session(session_id, session_obj, metadata, supersede=False):
+    """Store an isolated session, evicting the oldest beyond MAX_VIDEO_SESSIONS (or every other
+    session when superseding); returns the stored one if session_id is already present"""
+    with _sessions_lock:
+        existing = video_sessions.get(session_id)
+        if existing is not None:
+            session_obj.close()
+            return existing
+        if supersede:
+            # Release the older videos' pooled connections
+            for old_session in video_sessions.values():
+                old_session.close()
+            video_sessions.clear()
+            video_metadata.clear()
+        while len(video_sessions) >= MAX_VIDEO_SESSIONS:
+            old_id, old_session = video_sessions.popitem(last=False)
+            video_metadata.pop(old_id, None)
+            old_session.close()
+            logger.info(f"Evicted old session: {old_id}")
+        metadata['last_used'] = time.time()
+        video_sessions[session_id] = session_obj
+        video_metadata[session_id] = metadata
+        _sessions_changed.notify()
+        return session_obj
+
+def touch_video_session(session_id):
+    """Get (session, url) for an isolated session and mark it most recently used"""
+    with _sessions_lock:
+        session_obj = video_sessions.get(session_id)
+        if session_obj is None:
+            return None, None
+        metadata = video_metadata[session_id]
+        metadata['last_used'] = time.time()
+        video_sessions.move_to_end(session_id)
+        video_metadata.move_to_end(session_id)
+        return session_obj, metadata['url']
+
+def parse_range(range_header):
+    """Parse a single 'bytes=start-end' range into (start, end); end may be None"""
+    match = _RANGE_RE.match(range_header.strip()) if range_header else None
+    if not match:
+        return None, None
+    start = int(match.group(1))
+    end = int(match.group(2)) if match.group(2) else None
+    if end is not None and end < start:
+        return None, None
+    return start, end
+
+def clamp_range_header(range_header):
+    """Cap a client range at MAX_SINGLE_RANGE bytes so one request cannot pull the whole video"""
+    start, end = parse_range(range_header)
+    if start is None:
+        # Suffix and multi-part ranges are forwarded untouched
+        return range_header, None, None
+    capped_end = start + MAX_SINGLE_RANGE - 1
+    if end is None or end > capped_end:
+        end = capped_end
+    return f'bytes={start}-{end}', start, end
+
+def passthrough_headers(upstream_headers):
+    """Snapshot the upstream headers that are forwarded to the client unchanged"""
+    return {header: upstream_headers[header] for header in _PASSTHROUGH_HEADERS if header in upstream_headers}
+
+def synthesize_partial(response, range_start, range_end, resp_headers):
+    """Answer a range from byte 0 with a capped 206 when upstream ignored it and sent 200"""
+    total = resp_headers.get('Content-Length', '')
+    if response.status_code != 200 or range_start != 0 or not total.isdigit():
+        return response.status_code, None
+    total = int(total)
+    byte_limit = min(range_end + 1, total)
+    resp_headers['Content-Length'] = str(byte_limit)
+    resp_headers['Content-Range'] = f'bytes 0-{byte_limit - 1}/{total}'
+    return 206, byte_limit
+
+def limit_stream(chunks, byte_limit):
+    """Yield chunks until exactly byte_limit bytes have been produced"""
+    remaining = byte_limit
+    for chunk in chunks:
+        if len(chunk) >= remaining:
+            yield chunk[:remaining]
+            return
+        remaining -= len(chunk)
+        yield chunk
+
+def upstream_has_data(raw, timeout):
+    """True once the upstream socket turns readable within timeout seconds (or cannot be checked)"""
+    try:
+        readable, _, _ = select.select([raw.fileno()], [], [], timeout)
+    except (OSError, ValueError, AttributeError):
+        return True
+    return bool(readable)
+
+def read_into_buffer(raw, chunk_size):
+    """Coalesce raw upstream reads into one buffer per stream, yielding it when full or when upstream stalls"""
+    with memoryview(bytearray(chunk_size)) as view:
+        filled = 0
+        handed_out = time.monotonic()
+        while True:
+            # A partial chunk is stalled once upstream sends nothing for a whole
+            # STREAM_FLUSH_INTERVAL before the next read - not merely when a slow
+            # read has just drained the socket. Bytes left in the TLS or buffered
+            # reader layers are invisible to select(), but they only wait out
+            # such a gap, when the partial chunk goes out anyway
+            stalled = filled and not upstream_has_data(raw, STREAM_FLUSH_INTERVAL)
+            ended = False
+            if not stalled:
+                wanted = min(STREAM_READ_SIZE, chunk_size - filled)
+                # urllib3's own readinto() enforces Content-Length and hands the
+                # connection back to the pool at EOF, so close() does not drop it
+                count = raw.readinto(view[filled:filled + wanted])
+                filled += count
+                # Blocking reads only come back short once the body has ended
+                ended = count < wanted
+            if filled and (stalled or ended or filled == chunk_size):
+                now = time.monotonic()
+                # Since the previous chunk was handed out, the server wrote it to the
+                # client and this one was read from upstream - the end-to-end rate.
+                # Partial chunks count too, weighted by their size
+                record_throughput(filled, now - handed_out)
+                handed_out = now
+                # WSGI servers only accept bytes, so hand out a copy of the filled slice
+                yield bytes(view[:filled])
+                filled = 0
+            if ended:
+                break
+
+class BufferedBody:
+    """File-like face of read_into_buffer() for the WSGI file wrapper; read() returns one chunk"""
+
+    def __init__(self, raw, chunk_size):
+        self._chunks = read_into_buffer(raw, chunk_size)
+        self.close = raw.close
+
+    def read(self, size=-1):
+        return next(self._chunks, b'')
+
+def cork_client_socket():
+    """Set TCP_CORK on the gunicorn client socket, returning the callback that removes it"""
+    sock = request.environ.get('gunicorn.socket')
+    if sock is None or not hasattr(socket, 'TCP_CORK'):
+        return None
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+    except OSError:
+        return None
+    
+    def uncork():
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+        except OSError:
+            pass
+    return uncork
+
+def uncork_after_first_chunk(chunks, uncork):
+    """Yield chunks, uncorking once the server has written the headers and first chunk together"""
+    try:
+        first = next(chunks, None)
+        if first is not None:
+            yield first
+        uncork()
+        yield from chunks
+    finally:
+        uncork()
+        chunks.close()
+
+def upstream_body_response(response, body, status_code, resp_headers, mimetype, chunk_size, byte_limit):
+    """Response streaming an untouched upstream body to the client"""
+    # Headers and the first chunk leave in shared segments
+    uncork = cork_client_socket()
+    # Whole bodies go straight to the WSGI server's file wrapper, which runs
+    # the read/write loop itself over read_into_buffer() chunks; the body has
+    # no fileno() because sendfile(2)/splice(2) cannot apply to a TLS origin
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if file_wrapper is not None and byte_limit is None:
+        wrapper = file_wrapper(BufferedBody(response.raw, chunk_size), chunk_size)
+        if uncork is not None:
+            # Blocks are full-sized unless upstream stalls, and the cork only
+            # holds back a sub-segment tail, so stay corked until the server
+            # closes the wrapper and the tail is flushed
+            close_upstream = wrapper.close
+            
+            def close():
+                try:
+                    close_upstream()
+                finally:
+                    uncork()
+            wrapper.close = close
+        return Response(wrapper, status_code, headers=resp_headers, mimetype=mimetype,
+                        direct_passthrough=True)
+    
+    # The generator already yields bytes and closes upstream itself when the
+    # server closes it, so skip Werkzeug's per-chunk encoding wrapper
+    if uncork is not None:
+        body = uncork_after_first_chunk(body, uncork)
+    return Response(body, status_code, headers=resp_headers, mimetype=mimetype,
+                    direct_passthrough=True)
+
+# Whole-resource upstream headers per (URL, Accept-Encoding), least recently used first
+_upstream_meta = OrderedDict()
+_upstream_meta_lock = threading.Lock()
+
+class CachedUpstreamResponse:
+    """Stands in for an upstream HEAD response rebuilt from cached headers"""
+    status_code = 200
+
+    def __init__(self, headers):
+        self.headers = CaseInsensitiveDict(headers)
+
+    def raise_for_status(self):
+        pass
+
+    def close(self):
+        pass
+
+def cached_upstream_meta(key):
+    """Cached upstream headers for key, or None once they are older than UPSTREAM_META_TTL"""
+    with _upstream_meta_lock:
+        entry = _upstream_meta.get(key)
+        if entry is None:
+            return None
+        expires, headers = entry
+        if expires < time.time():
+            del _upstream_meta[key]
+            return None
+        _upstream_meta.move_to_end(key)
+        return headers
+
+def store_upstream_meta(key, response):
+    """Remember the whole-resource headers of a successful upstream response"""
+    headers = {header: response.headers[header]
+               for header in ('Content-Type',) + _PASSTHROUGH_HEADERS if header in response.headers}
+    with _upstream_meta_lock:
+        _upstream_meta[key] = (time.time() + UPSTREAM_META_TTL, headers)
+        _upstream_meta.move_to_end(key)
+        while len(_upstream_meta) > UPSTREAM_META_MAX:
+            _upstream_meta.popitem(last=False)
+
+def head_via_get(session_obj, video_url, headers, timeout):
+    """Ranged GET standing in for a HEAD the origin refused - presigned URLs are often signed
+    for GET only - with its headers rewritten to describe the whole resource"""
+    if 'Range' in headers:
+        # The client's own range is answered as-is
+        return session_obj.get(video_url, headers=headers, stream=True, timeout=timeout)
+    response = session_obj.get(video_url, headers={**headers, 'Range': 'bytes=0-0'}, stream=True, timeout=timeout)
+    total = response.headers.get('Content-Range', '').rpartition('/')[2]
+    if response.status_code == 206 and total.isdigit():
+        response.status_code = 200
+        response.headers['Content-Length'] = total
+        del response.headers['Content-Range']
+    return response
+
+def upstream_request(session_obj, video_url, headers, timeout):
+    """HEAD upstream for client HEADs (a ranged GET when upstream refuses HEAD), otherwise a streamed GET"""
+    # Only whole-resource answers are cached; ranged requests always go upstream
+    key = None if 'Range' in headers else (video_url, headers.get('Accept-Encoding'))
+    if request.method == 'HEAD':
+        if key is not None:
+            cached = cached_upstream_meta(key)
+            if cached is not None:
+                return CachedUpstreamResponse(cached)
+        response = session_obj.head(video_url, headers=headers, timeout=timeout, allow_redirects=True)
+        # Any 4xx may be HEAD-specific (405, or 403 from a URL signed for GET), so the
+        # GET decides - and a 403 there is what the Referer retry acts on
+        if 400 <= response.status_code < 500 or response.status_code == 501:
+            response.close()
+            response = head_via_get(session_obj, video_url, headers, timeout)
+    else:
+        response = session_obj.get(video_url, headers=headers, stream=True, timeout=timeout)
+    if key is not None and response.status_code == 200:
+        store_upstream_meta(key, response)
+    return response
+
+def explicit_video_url():
+    """True when the request names its video URL, so a cached answer cannot go stale on /set-video"""
+    return 'url' in request.args or 'url' in (request.view_args or {})
+
+def upstream_accept_encoding(video_url):
+    """Let the client's encodings through for manifests, request identity for media"""
+    extension = video_url.split('?', 1)[0].rsplit('.', 1)[-1].lower()
+    if extension in _MANIFEST_EXTENSIONS:
+        return request.headers.get('Accept-Encoding', 'identity')
+    return 'identity'
+
+def set_upstream_accept_encoding(headers, video_url):
+    """Override the session's identity Accept-Encoding only where it differs"""
+    encoding = upstream_accept_encoding(video_url)
+    if encoding != 'identity':
+        headers['Accept-Encoding'] = encoding
 
 def get_current_video_url():
-    """Get current video URL from session"""
-    return session.get('current_video_url', None)
+    """Get current video URL from shared state"""
+    return get_current_video()[0]
 
 def get_active_session_id():
-    """Get active session ID from session"""
-    return session.get('active_video_id', None)
+    """Get active session ID from shared state"""
+    return get_current_video()[1]
 
-def measure_network_speed():
-    """Measure network speed and adjust buffer sizes"""
+def get_cache_buster():
+    """Get the number of videos set so far"""
+    return _cache_buster.value
+
+def get_current_video():
+    """Get (url, active session ID, cache buster) from shared state in one consistent read"""
+    for _ in range(STATE_READ_RETRIES):
+        version = _current_state_version.value
+        url, video_id, cache_buster = _current_url.value, _current_video_id.value, _cache_buster.value
+        # An odd or moved version means a /set-video write overlapped the read
+        if not version & 1 and _current_state_version.value == version:
+            break
+    return url.decode('utf-8', 'replace') or None, video_id.decode('ascii', 'replace') or None, cache_buster
+
+def acquire_state_lock():
+    """Take the writer lock without blocking the gevent hub in sem_wait; False once
+    STATE_LOCK_TIMEOUT passes, as a worker killed mid-write never releases it"""
+    deadline = time.monotonic() + STATE_LOCK_TIMEOUT
+    while not _current_state_lock.acquire(block=False):
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.001)
+    return True
+
+def new_isolated_session(active_video_id, cache_buster):
+    """Create the upstream session dedicated to one video"""
+    return new_upstream_session({
+        'User-Agent': f'FastIsolated-{active_video_id}/3.0',
+        'Cache-Control': 'no-cache, no-store, must-revalidate, max-age=0',
+        'Pragma': 'no-cache',
+        'Expires': '0',
+        'Connection': 'keep-alive',
+        'X-Video-Session': active_video_id,
+        'X-Cache-Buster': str(cache_buster)
+    })
+
+def isolated_session_for(video_url):
+    """Get (session ID, session) when video_url is the current video, rebuilding the session
+    from shared state in workers that did not handle its /set-video"""
+    current_url, active_video_id, cache_buster = get_current_video()
+    if active_video_id is None or current_url != video_url:
+        return None, None
+    session_obj, _ = touch_video_session(active_video_id)
+    if session_obj is None:
+        session_obj = store_video_session(active_video_id, new_isolated_session(active_video_id, cache_buster), {
+            'url': current_url,
+            'created': time.time(),
+            'cache_buster': cache_buster,
+            'session_id': active_video_id
+        }, supersede=True)
+        logger.info(f"Rebuilt isolated session in worker {os.getpid()}: {active_video_id}")
+    return active_video_id, session_obj
+
+def set_current_video(new_url):
+    """Publish a new video to every worker, returning (active_video_id, cache_buster)"""
+    encoded = new_url.encode('utf-8')
+    if len(encoded) >= MAX_VIDEO_URL_BYTES:
+        return None, None
+    locked = acquire_state_lock()
+    if not locked:
+        logger.warning("Shared video state lock timed out, writing without it")
     try:
-        start_time = time.time()
-        headers = {
-            'User-Agent': 'FastSpeedTest/3.0',
-            'Cache-Control': 'no-cache, no-store, must-revalidate',
-            'Pragma': 'no-cache'
-        }
-        
-        # Use current video URL from session
-        current_url = get_current_video_url()
-        if not current_url:
-            logger.info("No video URL set, skipping network speed test")
-            return 0
-            
-        temp_session = requests.Session()
-        response = temp_session.get(current_url, headers=headers, stream=True, timeout=10)
-        
-        if response.status_code in [200, 206]:
-            downloaded = 0
-            for chunk in response.iter_content(chunk_size=8192):
-                downloaded += len(chunk)
-                if downloaded >= 128 * 1024:  # 128KB test
-                    break
-            
-            elapsed = time.time() - start_time
-            if elapsed > 0:
-                speed_kbps = (downloaded / 1024) / elapsed
-                logger.info(f"Network speed: {speed_kbps:.1f} KB/s")
-                return speed_kbps
-    except Exception as e:
-        logger.error(f"Network speed test failed: {e}")
-    return 0
+        cache_buster = _cache_buster.value + 1
+        active_video_id = f"isolated_{cache_buster}_{int(time.time())}"
+        # Odd while writing; a version left odd by a killed writer is reused
+        _current_state_version.value |= 1
+        _current_url.value = encoded
+        _current_video_id.value = active_video_id.encode('ascii')
+        _cache_buster.value = cache_buster
+        _current_state_version.value += 1
+    finally:
+        if locked:
+            _current_state_lock.release()
+    return active_video_id, cache_buster
+
+def record_throughput(byte_count, elapsed):
+    """Fold one chunk delivered by a real stream into the smoothed bandwidth, weighted so
+    that k chunks of NETWORK_SAMPLE_BYTES / k move it as far as one full sample"""
+    global _bw_ewma, _bw_samples
+    if elapsed <= 0:
+        return
+    samples = byte_count / NETWORK_SAMPLE_BYTES
+    _bw_samples += samples
+    speed_kbps = (byte_count / 1024) / elapsed
+    if _bw_ewma:
+        weight = 1 - (1 - NETWORK_EWMA_ALPHA) ** samples
+        _bw_ewma = weight * speed_kbps + (1 - weight) * _bw_ewma
+    else:
+        _bw_ewma = speed_kbps
+
+def measure_network_speed():
+    """Smoothed network speed in KB/s, measured on the chunks streams actually deliver"""
+    return _bw_ewma
+
+def adaptive_chunk_size(default_size):
+    """Size chunks to CHUNK_TARGET_LATENCY_MS of the smoothed bandwidth, keeping the
+    static size until NETWORK_MIN_SAMPLES real chunks have been measured"""
+    speed_kbps = measure_network_speed()
+    if not speed_kbps or _bw_samples < NETWORK_MIN_SAMPLES:
+        return default_size
+    chunk_size = int(speed_kbps * 1024 * CHUNK_TARGET_LATENCY_MS / 1000)
+    return max(MIN_CHUNK_SIZE, min(MAX_CHUNK_SIZE, chunk_size))
+
+def _base_url():
+    """External URL of this server - https for Replit deployments"""
+    host = request.host
+    scheme = 'https://' if host.partition(':')[0].endswith(_REPLIT_HOSTS) else 'http://'
+    return scheme + host
 
 @app.route('/')
 def home():
-    # Use proper external URL for Replit deployment
-    if 'replit.dev' in request.host or 'replit.app' in request.host:
-        base_url = f"https://{request.host}"
-    else:
-        base_url = f"http://{request.host}"
-    
+    base_url = _base_url()
     current_url = get_current_video_url()
     active_session = get_active_session_id()
-    cache_buster = session.get('cache_buster', 0)
-    return f"""
-<!DOCTYPE html>
-<html>
-<head>
-    <title>Isolated Fast Video Streaming</title>
-    <link href="https://cdn.replit.com/agent/bootstrap-agent-dark-theme.min.css" rel="stylesheet">
-    <meta name="viewport" content="width=device-width, initial-scale=1">
-    <script>
-        // Keep-alive mechanism to prevent app from going offline
-        setInterval(function() {{
-            fetch('/keepalive', {{method: 'GET'}}).catch(function(error) {{
-                console.log('Keep-alive ping failed:', error);
-            }});
-        }}, 30000); // Ping every 30 seconds
-        
-        // Also ping when page becomes visible again
-        document.addEventListener('visibilitychange', function() {{
-            if (!document.hidden) {{
-                fetch('/keepalive', {{method: 'GET'}}).catch(function(error) {{
-                    console.log('Visibility ping failed:', error);
-                }});
-            }}
-        }});
-    </script>
-</head>
-<body>
-    <div class="container mt-4">
-        <div class="row justify-content-center">
-            <div class="col-lg-8">
-                <h1 class="text-center mb-4">🎬 Isolated Fast Video Streaming Server</h1>
-                
-                <div class="alert alert-success text-center" role="alert">
-                    <h4 class="alert-heading">✓ ISOLATED SYSTEM v3.0</h4>
-                    <p class="mb-2">Zero video switching + Fast 1MB chunk loading</p>
-                    <p class="mb-2"><strong>✓ Chrome Browser</strong> + <strong>✓ External Players</strong> (VLC, MPV, MX Player, etc.)</p>
-                    <hr>
-                    <p class="mb-0 small">
-                        <strong>Session:</strong> {active_session or 'None'} | 
-                        <strong>Cache:</strong> {cache_buster} | 
-                        <strong>Time:</strong> {datetime.now().strftime('%H:%M:%S')}
-                    </p>
-                </div>
-
-                <div class="card mb-4">
-                    <div class="card-header">
-                        <h5 class="card-title mb-0">📹 Set Video URL</h5>
-                    </div>
-                    <div class="card-body">
-                        <form action="/set-video" method="post">
-                            <div class="mb-3">
-                                <input type="text" name="video_url" class="form-control" 
-                                       placeholder="Enter video URL here..." 
-                                       value="{current_url if current_url else ''}" required>
-                            </div>
-                            <button type="submit" class="btn btn-primary btn-lg w-100">
-                                🔄 Set Video (Complete Isolation)
-                            </button>
-                        </form>
-                    </div>
-                </div>
-
-                <div class="card mb-4">
-                    <div class="card-header">
-                        <h5 class="card-title mb-0">🎬 Chrome Browser URLs</h5>
-                    </div>
-                    <div class="card-body">
-                        <div class="mb-3">
-                            <label class="form-label"><strong>Primary (1MB chunks):</strong></label>
-                            <div class="input-group">
-                                <input type="text" value="{base_url}/video" readonly 
-                                       class="form-control font-monospace" onclick="this.select()">
-                                <button class="btn btn-outline-secondary" type="button" 
-                                        onclick="navigator.clipboard.writeText(this.previousElementSibling.value)">
-                                    📋 Copy
-                                </button>
-                            </div>
-                        </div>
-                        <div class="mb-3">
-                            <label class="form-label"><strong>Fast Mode (Instant loading):</strong></label>
-                            <div class="input-group">
-                                <input type="text" value="{base_url}/fast" readonly 
-                                       class="form-control font-monospace" onclick="this.select()">
-                                <button class="btn btn-outline-secondary" type="button" 
-                                        onclick="navigator.clipboard.writeText(this.previousElementSibling.value)">
-                                    📋 Copy
-                                </button>
-                            </div>
-                        </div>
-                    </div>
-                </div>
-
-                <div class="card mb-4 border-success">
-                    <div class="card-header bg-success text-white">
-                        <h5 class="card-title mb-0">📱 MX Player URLs (Use these for MX Player!)</h5>
-                    </div>
-                    <div class="card-body">
-                        {'<div class="mb-3"><label class="form-label"><strong>MX Player Optimized:</strong></label><div class="input-group"><input type="text" value="' + base_url + '/mx?url=' + (current_url or 'SET_VIDEO_URL_FIRST') + '" readonly class="form-control font-monospace" onclick="this.select()"><button class="btn btn-success" type="button" onclick="navigator.clipboard.writeText(this.previousElementSibling.value)">📋 Copy for MX Player</button></div></div>' if current_url else '<div class="alert alert-warning"><strong>Set video URL first</strong> to generate MX Player links</div>'}
-                        {'<div class="mb-3"><label class="form-label"><strong>Standard with URL:</strong></label><div class="input-group"><input type="text" value="' + base_url + '/video?url=' + (current_url or 'SET_VIDEO_URL_FIRST') + '" readonly class="form-control font-monospace small" onclick="this.select()"><button class="btn btn-outline-success" type="button" onclick="navigator.clipboard.writeText(this.previousElementSibling.value)">📋 Copy</button></div></div>' if current_url else ''}
-                        {'<div class="mb-0"><label class="form-label"><strong>Fast with URL:</strong></label><div class="input-group"><input type="text" value="' + base_url + '/fast?url=' + (current_url or 'SET_VIDEO_URL_FIRST') + '" readonly class="form-control font-monospace small" onclick="this.select()"><button class="btn btn-outline-success" type="button" onclick="navigator.clipboard.writeText(this.previousElementSibling.value)">📋 Copy</button></div></div>' if current_url else ''}
-                        <div class="alert alert-info mt-3 mb-0">
-                            <strong>⚠️ Important:</strong> For MX Player, you MUST use the URLs above that include "?url=" parameter. The Chrome browser URLs won't work in MX Player.
-                        </div>
-                    </div>
-                </div>
-
-                <div class="d-grid gap-2 d-md-flex justify-content-md-center">
-                    <a href="/video" class="btn btn-success btn-lg">
-                        ▶️ Test Current Video
-                    </a>
-                    <a href="/test-isolation" class="btn btn-info btn-lg">
-                        🔍 Test Isolation
-                    </a>
-                </div>
-
-                <div class="mt-4 text-center">
-                    <small class="text-muted">
-                        Deployed on Railway.app | Fast streaming with complete isolation
-                    </small>
-                </div>
-            </div>
-        </div>
-    </div>
-    
-    <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/js/bootstrap.bundle.min.js"></script>
-</body>
-</html>
-    """
+    cache_buster = get_cache_buster()
+    return render_page(
+        _HOME_TMPL,
+        base_url=base_url,
+        current_url=current_url,
+        active_session=active_session,
+        cache_buster=cache_buster,
+        now=datetime.now().strftime('%H:%M:%S')
+    )
 
 @app.route('/set-video', methods=['POST'])
 def set_video():
     new_url = request.form.get('video_url', '').strip()
     if new_url:
-        # Store in Flask session for cross-worker persistence
-        cache_buster = session.get('cache_buster', 0) + 1
-        active_video_id = f"isolated_{cache_buster}_{int(time.time())}"
-        
-        # Store in session
-        session['current_video_url'] = new_url
-        session['active_video_id'] = active_video_id
-        session['cache_buster'] = cache_buster
-        
-        # Clear local worker sessions
-        video_sessions.clear()
-        video_metadata.clear()
+        # Store in shared state for cross-worker persistence
+        active_video_id, cache_buster = set_current_video(new_url)
+        if active_video_id is None:
+            logger.warning(f"Rejected video URL longer than {MAX_VIDEO_URL_BYTES} bytes")
+            return redirect('/')
         
         # CREATE COMPLETELY ISOLATED SESSION
-        isolated_session = requests.Session()
-        isolated_session.headers.update({
-            'User-Agent': f'FastIsolated-{active_video_id}/3.0',
-            'Cache-Control': 'no-cache, no-store, must-revalidate, max-age=0',
-            'Pragma': 'no-cache',
-            'Expires': '0',
-            'Connection': 'keep-alive',
-            'X-Video-Session': active_video_id,
-            'X-Cache-Buster': str(cache_buster)
-        })
+        isolated_session = new_isolated_session(active_video_id, cache_buster)
         
-        # STORE ISOLATED SESSION
-        video_sessions[active_video_id] = isolated_session
-        video_metadata[active_video_id] = {
+        # STORE ISOLATED SESSION, clearing local worker sessions; other workers
+        # rebuild theirs from shared state on their first stream
+        isolated_session = store_video_session(active_video_id, isolated_session, {
             'url': new_url,
             'created': time.time(),
             'cache_buster': cache_buster,
             'session_id': active_video_id
-        }
-        
-        # FORCE COMPLETE MEMORY CLEANUP
-        gc.collect()
+        }, supersede=True)
+        prewarm_upstream(isolated_session, new_url)
         
         logger.info(f"COMPLETE ISOLATION: {active_video_id}")
         logger.info(f"ALL OLD SESSIONS DESTROYED")
         logger.info(f"NEW VIDEO ISOLATED: {new_url[:50]}...")
         
-        # Use proper external URL for Replit deployment
-        if 'replit.dev' in request.host or 'replit.app' in request.host:
-            base_url = f"https://{request.host}"
-        else:
-            base_url = f"http://{request.host}"
-        return f"""
-<!DOCTYPE html>
-<html>
-<head>
-    <title>Video Isolated Successfully</title>
-    <link href="https://cdn.replit.com/agent/bootstrap-agent-dark-theme.min.css" rel="stylesheet">
-    <meta name="viewport" content="width=device-width, initial-scale=1">
-</head>
-<body>
-    <div class="container mt-5">
-        <div class="row justify-content-center">
-            <div class="col-lg-6">
-                <div class="text-center mb-4">
-                    <h2>✅ Video Completely Isolated!</h2>
-                </div>
-                
-                <div class="alert alert-success" role="alert">
-                    <h4 class="alert-heading">🎯 ISOLATION COMPLETE!</h4>
-                    <p><strong>Session ID:</strong> {active_video_id}</p>
-                    <p><strong>Cache Buster:</strong> #{cache_buster}</p>
-                    <p><strong>Time:</strong> {datetime.now().strftime('%H:%M:%S')}</p>
-                    <p class="mb-0">Zero contamination from old videos!</p>
-                </div>
-                
-                <div class="card mb-4">
-                    <div class="card-header">
-                        <h6 class="card-title mb-0">📹 New Video Isolated</h6>
-                    </div>
-                    <div class="card-body">
-                        <p class="small text-break bg-light p-2 rounded">{new_url}</p>
-                        <p class="text-muted mb-0">Fast 1MB chunk streaming ready</p>
-                    </div>
-                </div>
-
-                <div class="card mb-4">
-                    <div class="card-header">
-                        <h6 class="card-title mb-0">🚀 Fast Streaming URLs</h6>
-                    </div>
-                    <div class="card-body">
-                        <div class="mb-3">
-                            <input type="text" value="{base_url}/video" readonly 
-                                   class="form-control font-monospace" onclick="this.select()">
-                        </div>
-                        <div class="mb-0">
-                            <input type="text" value="{base_url}/fast" readonly 
-                                   class="form-control font-monospace" onclick="this.select()">
-                        </div>
-                    </div>
-                </div>
-
-                <div class="d-grid gap-2 d-md-flex justify-content-md-center">
-                    <a href="/" class="btn btn-outline-primary">← Back to Home</a>
-                    <a href="/video" class="btn btn-success">▶️ Test Video</a>
-                </div>
-            </div>
-        </div>
-    </div>
-    
-    <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/js/bootstrap.bundle.min.js"></script>
-</body>
-</html>
-        """
+        return render_page(
+            _SET_VIDEO_TMPL,
+            base_url=_base_url(),
+            active_video_id=active_video_id,
+            cache_buster=cache_buster,
+            new_url=new_url,
+            now=datetime.now().strftime('%H:%M:%S')
+        )
     return redirect('/')
 
 @app.route('/video', methods=['GET', 'HEAD', 'OPTIONS'])
@@ -362,13 +722,12 @@ def video():
     # Check for URL parameter for direct streaming (MX Player support)
     url_param = request.args.get('url')
     if url_param:
-        logger.info(f"Direct URL streaming request from: {request.headers.get('User-Agent', 'Unknown')}")
+        logger.debug("Direct URL streaming request from: %s", request.headers.get('User-Agent', 'Unknown'))
         return stream_video(url_param, mode='standard')
     
     if not video_url:
         # Handle MX Player and other external players when no video URL is set
-        user_agent = request.headers.get('User-Agent', '')
-        if 'MX Player' in user_agent or 'mxplayer' in user_agent.lower():
+        if _MX_PLAYER_RE.search(request.headers.get('User-Agent', '')):
             return Response(
                 "MX Player Support: Add ?url=YOUR_VIDEO_URL to this endpoint or set video URL on main page first",
                 status=400,
@@ -398,13 +757,12 @@ def fast_video():
     # Check for URL parameter for direct streaming (MX Player support)
     url_param = request.args.get('url')
     if url_param:
-        logger.info(f"Direct URL fast streaming request from: {request.headers.get('User-Agent', 'Unknown')}")
+        logger.debug("Direct URL fast streaming request from: %s", request.headers.get('User-Agent', 'Unknown'))
         return stream_video(url_param, mode='fast')
     
     if not video_url:
         # Handle MX Player and other external players when no video URL is set
-        user_agent = request.headers.get('User-Agent', '')
-        if 'MX Player' in user_agent or 'mxplayer' in user_agent.lower():
+        if _MX_PLAYER_RE.search(request.headers.get('User-Agent', '')):
             return Response(
                 "MX Player Support: Add ?url=YOUR_VIDEO_URL to this endpoint or set video URL on main page first",
                 status=400,
@@ -423,7 +781,7 @@ def proxy_video(url):
     decoded_url = unquote(url)
     if not decoded_url.startswith('http'):
         decoded_url = 'https://' + decoded_url
-    logger.info(f"Proxy request: {decoded_url[:50]}...")
+    logger.debug("Proxy request: %.50s...", decoded_url)
     return stream_video(decoded_url, mode='fast')
 
 @app.route('/mx', methods=['GET', 'HEAD', 'OPTIONS'])
@@ -452,7 +810,7 @@ def mx_player_stream():
             )
         url_param = video_url
     
-    logger.info(f"MX Player stream request: {url_param[:50]}... from {request.headers.get('User-Agent', 'Unknown')}")
+    logger.debug("MX Player stream request: %.50s... from %s", url_param, request.headers.get('User-Agent', 'Unknown'))
     
     # Stream with MX Player optimized mode
     return stream_video_mx_optimized(url_param)
@@ -461,25 +819,18 @@ def stream_video_mx_optimized(video_url):
     """Specialized MX Player streaming function"""
     try:
         # Simple, direct streaming optimized for MX Player
-        session_obj = requests.Session()
-        session_obj.headers.update({
-            'User-Agent': 'MXPlayer/1.46.15 (Android)',
-            'Accept': 'video/mp4,video/*,*/*',
-            'Accept-Language': 'en-US,en;q=0.9',
-            'Connection': 'keep-alive',
-            'Accept-Encoding': 'identity',
-            'Cache-Control': 'no-cache',
-            'Pragma': 'no-cache'
-        })
+        mx_headers = _MX_UPSTREAM_HEADERS.copy()
         
-        range_header = request.headers.get('Range')
+        range_header, range_start, range_end = clamp_range_header(request.headers.get('Range'))
         if range_header:
-            session_obj.headers['Range'] = range_header
+            mx_headers['Range'] = range_header
+        set_upstream_accept_encoding(mx_headers, video_url)
         
-        response = session_obj.get(video_url, stream=True, timeout=30)
+        response = upstream_request(UPSTREAM_SESSION, video_url, mx_headers, 30)
         response.raise_for_status()
         
         content_type = response.headers.get('Content-Type', 'video/mp4')
+        passthrough = passthrough_headers(response.headers)
         
         # Force video/mp4 for maximum MX Player compatibility
         if not content_type.startswith('video/'):
@@ -487,59 +838,49 @@ def stream_video_mx_optimized(video_url):
         
         # Handle HEAD requests - MX Player checks video info first
         if request.method == 'HEAD':
-            resp_headers = {
-                'Content-Type': content_type,
-                'Accept-Ranges': 'bytes',
-                'Connection': 'keep-alive',
-                'X-MX-Player-Compatible': 'true',
-                'X-Android-Compatible': 'true',
-                'Access-Control-Allow-Origin': '*',
-                'Content-Disposition': 'inline; filename="video.mp4"'
-            }
+            resp_headers = _MX_HEAD_HEADERS.copy()
+            resp_headers['Content-Type'] = content_type
+            if explicit_video_url():
+                # Let players and intermediaries absorb repeated probes of this URL
+                resp_headers['Cache-Control'] = HEAD_CACHE_CONTROL
             
             # Copy essential headers
-            for header in ['Content-Length', 'Content-Range', 'Last-Modified', 'ETag']:
-                if header in response.headers:
-                    resp_headers[header] = response.headers[header]
+            resp_headers.update(passthrough)
             
-            return Response('', headers=resp_headers, mimetype=content_type)
+            # Only the headers were needed - free the upstream connection now
+            response.close()
+            # No body, so the upstream Content-Length is reported as-is
+            return Response(headers=resp_headers, mimetype=content_type)
         
         # Stream video data
         def generate():
             try:
-                for chunk in response.iter_content(chunk_size=FAST_CHUNK_SIZE):
+                # Raw, still-encoded bytes so Content-Length/Content-Encoding stay valid
+                chunks = read_into_buffer(response.raw, FAST_CHUNK_SIZE)
+                if byte_limit is not None:
+                    chunks = limit_stream(chunks, byte_limit)
+                for chunk in chunks:
                     if chunk:
                         yield chunk
             except Exception as e:
                 logger.error(f"MX Player streaming error: {e}")
                 raise
+            finally:
+                # Also runs on GeneratorExit when the player disconnects mid-stream
+                response.close()
         
         # Response headers optimized for MX Player
-        resp_headers = {
-            'Content-Type': content_type,
-            'Accept-Ranges': 'bytes',
-            'Connection': 'keep-alive',
-            'X-MX-Player-Compatible': 'true',
-            'X-Android-Compatible': 'true',
-            'X-Video-Direct-Stream': 'true',
-            'Access-Control-Allow-Origin': '*',
-            'Content-Disposition': 'inline; filename="video.mp4"',
-            'Cache-Control': 'no-cache'
-        }
+        resp_headers = _MX_STREAM_HEADERS.copy()
+        resp_headers['Content-Type'] = content_type
         
         # Copy essential headers from source
-        for header in ['Content-Length', 'Content-Range', 'Last-Modified', 'ETag']:
-            if header in response.headers:
-                resp_headers[header] = response.headers[header]
+        resp_headers.update(passthrough)
         
-        logger.info(f"MX Player stream initiated - Status: {response.status_code}")
+        status_code, byte_limit = synthesize_partial(response, range_start, range_end, resp_headers)
+        logger.debug("MX Player stream initiated - Status: %s", status_code)
         
-        return Response(
-            generate(),
-            response.status_code,
-            headers=resp_headers,
-            mimetype=content_type
-        )
+        return upstream_body_response(response, generate(), status_code, resp_headers,
+                                      content_type, FAST_CHUNK_SIZE, byte_limit)
         
     except Exception as e:
         logger.error(f"MX Player streaming error: {e}")
@@ -553,63 +894,29 @@ def stream_video_mx_optimized(video_url):
 def test_isolation():
     """Test endpoint to verify isolation system"""
     active_session = get_active_session_id()
-    cache_buster = session.get('cache_buster', 0)
+    cache_buster = get_cache_buster()
     current_url = get_current_video_url()
     
-    return f"""
-<!DOCTYPE html>
-<html>
-<head>
-    <title>Isolation System Test</title>
-    <link href="https://cdn.replit.com/agent/bootstrap-agent-dark-theme.min.css" rel="stylesheet">
-    <meta name="viewport" content="width=device-width, initial-scale=1">
-</head>
-<body>
-    <div class="container mt-5">
-        <div class="row justify-content-center">
-            <div class="col-lg-6">
-                <div class="text-center mb-4">
-                    <h2>🔍 Isolation System Status</h2>
-                </div>
-                
-                <div class="alert alert-info" role="alert">
-                    <h4 class="alert-heading">✅ SYSTEM ACTIVE</h4>
-                    <p><strong>Active Session:</strong> {active_session or 'None'}</p>
-                    <p><strong>Cache Buster:</strong> #{cache_buster}</p>
-                    <p><strong>Sessions Count:</strong> {len(video_sessions)}</p>
-                    <p><strong>Timestamp:</strong> {datetime.now().strftime('%H:%M:%S')}</p>
-                    <p class="mb-0"><strong>Version:</strong> Isolated Fast Stream v3.0</p>
-                </div>
-                
-                <div class="card mb-4">
-                    <div class="card-header">
-                        <h6 class="card-title mb-0">📹 Current Video</h6>
-                    </div>
-                    <div class="card-body">
-                        <p class="small text-break">{current_url[:100] + '...' if current_url else 'No video URL set'}</p>
-                    </div>
-                </div>
-                
-                <div class="alert alert-success" role="alert">
-                    If you see session information above, the isolation system is working!
-                </div>
-                
-                <div class="text-center">
-                    <a href="/" class="btn btn-primary">← Back to Home</a>
-                </div>
-            </div>
-        </div>
-    </div>
-    
-    <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/js/bootstrap.bundle.min.js"></script>
-</body>
-</html>
-    """
+    return render_page(
+        _TEST_ISOLATION_TMPL,
+        active_session=active_session,
+        cache_buster=cache_buster,
+        sessions_count=len(video_sessions),
+        current_url=current_url,
+        now=datetime.now().strftime('%H:%M:%S')
+    )
+
+@app.route('/static/<path:filename>')
+def static_files(filename):
+    """Dashboard assets, cached by browsers for STATIC_MAX_AGE"""
+    response = send_from_directory('static', filename, max_age=STATIC_MAX_AGE)
+    response.headers['Cache-Control'] = f'public, max-age={STATIC_MAX_AGE}, immutable'
+    return response
 
 @app.route('/health')
 def health_check():
     """Health check endpoint for Railway"""
-    cache_buster = session.get('cache_buster', 0)
+    cache_buster = get_cache_buster()
     return jsonify({
         'status': 'healthy',
         'timestamp': datetime.now().isoformat(),
@@ -631,188 +938,125 @@ def stream_video(video_url, mode='standard'):
     """ISOLATED FAST STREAMING - Prevents video switching with rapid loading"""
     def generate_stream():
         try:
-            # Get session info from Flask session
-            active_session_id = get_active_session_id()
-            
-            # USE ONLY ISOLATED SESSION - Force use of active session
-            if active_session_id and active_session_id in video_sessions:
-                session_obj = video_sessions[active_session_id]
-                # Use URL from session metadata to ensure complete isolation
-                actual_video_url = video_metadata[active_session_id]['url']
-                logger.info(f"Using isolated session: {active_session_id} with URL: {actual_video_url[:50]}...")
+            # USE ONLY ISOLATED SESSION - Force use of active session; requests
+            # naming another URL (?url=, /proxy/) are not the dashboard video
+            active_session_id, session_obj = isolated_session_for(video_url)
+            actual_video_url = video_url
+            if session_obj is not None:
+                logger.debug("Using isolated session: %s with URL: %.50s...", active_session_id, actual_video_url)
             else:
-                # Create new isolated session if none exists
-                cache_buster = session.get('cache_buster', 0) + 1
-                active_session_id = f"isolated_{cache_buster}_{int(time.time())}"
-                
-                session_obj = requests.Session()
-                session_obj.headers.update({
-                    'User-Agent': f'FastIsolated-{active_session_id}/3.0',
-                    'Cache-Control': 'no-cache, no-store, must-revalidate',
-                    'Pragma': 'no-cache'
-                })
-                
-                # Store the session and metadata
-                video_sessions[active_session_id] = session_obj
-                video_metadata[active_session_id] = {
-                    'url': video_url,
-                    'created': time.time(),
-                    'cache_buster': cache_buster,
-                    'session_id': active_session_id
-                }
-                actual_video_url = video_url
-                logger.info(f"Created new isolated session: {active_session_id} with URL: {actual_video_url[:50]}...")
+                # No isolated session in this worker - stream through the shared pool
+                # rather than building (and leaking) a fresh session per request
+                session_obj = UPSTREAM_SESSION
+                logger.debug("Using shared upstream session with URL: %.50s...", actual_video_url)
             
             # FAST STREAMING REQUEST WITH MX PLAYER OPTIMIZATION
-            range_header = request.headers.get('Range')
-            user_agent = request.headers.get('User-Agent', '')
-            is_mx_player = 'MX Player' in user_agent or 'mxplayer' in user_agent.lower()
-            
-            # Enhanced MX Player detection
-            is_android_player = any(x in user_agent.lower() for x in ['android', 'mobile', 'mxplayer'])
-            
-            headers = {
-                'User-Agent': f'FastStreamProxy-{active_session_id or "fallback"}/3.0' if not is_mx_player else 'MXPlayer/1.46.15',
-                'Accept': '*/*',
-                'Connection': 'keep-alive',
-                'Accept-Encoding': 'identity',
-                'Referer': 'https://moviebox.ng/',
-            }
+            range_header, range_start, range_end = clamp_range_header(request.headers.get('Range'))
+            # Enhanced MX Player detection - one scan covers MX, Android and mobile players
+            is_mx_player = bool(_MOBILE_PLAYER_RE.search(request.headers.get('User-Agent', '')))
             
             # MX Player requires specific headers for proper playback
-            if is_mx_player or is_android_player:
-                headers.update({
-                    'User-Agent': 'MXPlayer/1.46.15 (Android)',
-                    'Accept': 'video/mp4,video/*,*/*',
-                    'Accept-Language': 'en-US,en;q=0.9',
-                    'Cache-Control': 'no-cache',
-                    'Pragma': 'no-cache'
-                })
+            if is_mx_player:
+                headers = _MX_UPSTREAM_HEADERS.copy()
+            else:
+                headers = {'User-Agent': f'FastStreamProxy-{active_session_id or "fallback"}/3.0'}
+            headers['Referer'] = referer_for(actual_video_url)
             
             if range_header:
                 headers['Range'] = range_header
+            set_upstream_accept_encoding(headers, actual_video_url)
             
-            response = session_obj.get(actual_video_url, headers=headers, stream=True, timeout=20)
+            response = upstream_request(session_obj, actual_video_url, headers, 20)
             
             if response.status_code == 403:
-                headers['Referer'] = 'https://valiw.hakunaymatata.com/'
-                response = session_obj.get(actual_video_url, headers=headers, stream=True, timeout=20)
+                response.close()
+                headers['Referer'] = FALLBACK_REFERER if headers['Referer'] == ORIGIN_REFERER else ORIGIN_REFERER
+                response = upstream_request(session_obj, actual_video_url, headers, 20)
+                # Only an answer with the body proves the Referer works
+                if 200 <= response.status_code < 300:
+                    remember_referer(actual_video_url, headers['Referer'])
             
             response.raise_for_status()
+            upstream_type = response.headers.get('Content-Type', 'video/mp4')
+            passthrough = passthrough_headers(response.headers)
             
-            # DETERMINE CHUNK SIZE BASED ON MODE
+            # DETERMINE CHUNK SIZE BASED ON MODE AND MEASURED BANDWIDTH
             if mode == 'fast':
-                chunk_size = FAST_CHUNK_SIZE
-                logger.info(f"Fast streaming mode: {chunk_size} bytes chunks")
+                chunk_size = adaptive_chunk_size(FAST_CHUNK_SIZE)
+                logger.debug("Fast streaming mode: %d bytes chunks", chunk_size)
             else:
-                chunk_size = STANDARD_CHUNK_SIZE
-                logger.info(f"Standard streaming mode: {chunk_size} bytes chunks")
+                chunk_size = adaptive_chunk_size(STANDARD_CHUNK_SIZE)
+                logger.debug("Standard streaming mode: %d bytes chunks", chunk_size)
             
             # STREAM WITH APPROPRIATE HEADERS
             def generate():
                 try:
-                    for chunk in response.iter_content(chunk_size=chunk_size):
+                    # Raw, still-encoded bytes so Content-Length/Content-Encoding stay valid
+                    chunks = read_into_buffer(response.raw, chunk_size)
+                    if byte_limit is not None:
+                        chunks = limit_stream(chunks, byte_limit)
+                    for chunk in chunks:
                         if chunk:
                             yield chunk
                 except Exception as e:
                     logger.error(f"Streaming error: {e}")
                     raise
+                finally:
+                    # Also runs on GeneratorExit when the client disconnects mid-stream
+                    response.close()
             
             # Handle HEAD requests for external players including MX Player
             if request.method == 'HEAD':
-                content_type = response.headers.get('Content-Type', 'video/mp4')
-                resp_headers = {
-                    'Content-Type': content_type,
-                    'Accept-Ranges': 'bytes',
-                    'Access-Control-Allow-Origin': '*',
-                    'Access-Control-Allow-Methods': 'GET, HEAD, OPTIONS',
-                    'Access-Control-Allow-Headers': 'Range, Content-Type, Authorization, User-Agent',
-                    'Access-Control-Expose-Headers': 'Content-Length, Content-Range, Accept-Ranges',
-                    'Content-Disposition': f'inline; filename="video.{content_type.split("/")[-1] if "/" in content_type else "mp4"}"',
-                    'X-Content-Type-Options': 'nosniff',
-                    'Connection': 'keep-alive',
-                    'Server': 'nginx/1.18.0',
-                    'Cache-Control': 'no-cache'
-                }
+                content_type = upstream_type
+                resp_headers = _STREAM_HEAD_HEADERS.copy()
+                resp_headers['Content-Type'] = content_type
+                if explicit_video_url():
+                    # Let players and intermediaries absorb repeated probes of this URL
+                    resp_headers['Cache-Control'] = HEAD_CACHE_CONTROL
+                resp_headers['Content-Disposition'] = f'inline; filename="video.{content_type.split("/")[-1] if "/" in content_type else "mp4"}"'
                 
                 # Copy essential headers from source
-                for header in ['Content-Length', 'Content-Range', 'Last-Modified', 'ETag']:
-                    if header in response.headers:
-                        resp_headers[header] = response.headers[header]
+                resp_headers.update(passthrough)
                 
                 # Enhanced MX Player specific optimizations
-                if is_mx_player or is_android_player:
-                    resp_headers.update({
-                        'X-MX-Player-Compatible': 'true',
-                        'Transfer-Encoding': 'identity',
-                        'X-Android-Compatible': 'true',
-                        'X-Video-Direct-Stream': 'true',
-                        'Vary': 'Accept-Encoding',
-                        'Content-Security-Policy': 'default-src *'
-                    })
+                if is_mx_player:
+                    resp_headers.update(_STREAM_HEAD_MX_HEADERS)
                     # Force video/mp4 for better compatibility
                     if not content_type.startswith('video/'):
                         resp_headers['Content-Type'] = 'video/mp4'
                         content_type = 'video/mp4'
                     
-                return Response('', headers=resp_headers, mimetype=content_type)
+                # Only the headers were needed - free the upstream connection now
+                response.close()
+                # No body, so the upstream Content-Length is reported as-is
+                return Response(headers=resp_headers, mimetype=content_type)
             
             # PREPARE RESPONSE HEADERS FOR BROWSERS, EXTERNAL PLAYERS AND MX PLAYER
-            content_type = response.headers.get('Content-Type', 'video/mp4')
+            content_type = upstream_type
             
-            resp_headers = {
-                'Content-Type': content_type,
-                'Accept-Ranges': 'bytes',
-                'Cache-Control': 'no-cache, no-store, must-revalidate',
-                'Pragma': 'no-cache',
-                'Expires': '0',
-                'X-Video-Session': active_session_id or 'fallback',
-                'X-Stream-Mode': mode,
-                'X-Chunk-Size': str(chunk_size),
-                # External player compatibility headers
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, HEAD, OPTIONS',
-                'Access-Control-Allow-Headers': 'Range, Content-Type, Authorization, User-Agent',
-                'Access-Control-Expose-Headers': 'Content-Length, Content-Range, Accept-Ranges',
-                'Content-Disposition': 'inline; filename="video.mp4"',
-                'X-Content-Type-Options': 'nosniff',
-                # MX Player and mobile player specific headers
-                'Connection': 'keep-alive',
-                'Transfer-Encoding': 'identity',
-                'Server': 'nginx/1.18.0',
-                'X-Frame-Options': 'SAMEORIGIN',
-                'Vary': 'Accept-Encoding'
-            }
+            resp_headers = _STREAM_GET_HEADERS.copy()
+            resp_headers['Content-Type'] = content_type
+            resp_headers['X-Video-Session'] = active_session_id or 'fallback'
+            resp_headers['X-Stream-Mode'] = mode
+            resp_headers['X-Chunk-Size'] = str(chunk_size)
             
             # Enhanced MX Player compatibility headers
-            if is_mx_player or is_android_player:
-                resp_headers.update({
-                    'X-MX-Player-Compatible': 'true',
-                    'X-Android-Compatible': 'true',
-                    'X-Video-Direct-Stream': 'true',
-                    'Content-Security-Policy': 'default-src *',
-                    'X-Content-Type-Options': 'nosniff'
-                })
+            if is_mx_player:
+                resp_headers.update(_STREAM_GET_MX_HEADERS)
                 # Force video/mp4 for better compatibility
                 if not content_type.startswith('video/'):
                     resp_headers['Content-Type'] = 'video/mp4'
                     content_type = 'video/mp4'
-                logger.info(f"MX Player request detected, optimized headers applied")
+                logger.debug("MX Player request detected, optimized headers applied")
             
             # COPY ESSENTIAL HEADERS FROM SOURCE
-            for header in ['Content-Length', 'Content-Range', 'Last-Modified', 'ETag']:
-                if header in response.headers:
-                    resp_headers[header] = response.headers[header]
+            resp_headers.update(passthrough)
             
-            status_code = response.status_code
-            logger.info(f"Streaming initiated - Status: {status_code}, Mode: {mode}, Session: {active_session_id}")
+            status_code, byte_limit = synthesize_partial(response, range_start, range_end, resp_headers)
+            logger.debug("Streaming initiated - Status: %s, Mode: %s, Session: %s", status_code, mode, active_session_id)
             
-            return Response(
-                generate(),
-                status_code,
-                headers=resp_headers,
-                mimetype=response.headers.get('Content-Type', 'video/mp4')
-            )
+            return upstream_body_response(response, generate(), status_code, resp_headers,
+                                          upstream_type, chunk_size, byte_limit)
             
         except requests.exceptions.RequestException as e:
             logger.error(f"Request error: {e}")
@@ -831,9 +1075,8 @@ def stream_video(video_url, mode='standard'):
     
     return generate_stream()
 
-@app.errorhandler(404)
-def not_found(error):
-    return f"""
+# Error pages have no dynamic parts, so they are encoded once at import
+_NOT_FOUND_PAGE = """
 <!DOCTYPE html>
 <html>
 <head>
@@ -854,11 +1097,8 @@ def not_found(error):
     </div>
 </body>
 </html>
-    """, 404
-
-@app.errorhandler(500)
-def internal_error(error):
-    return f"""
+    """.encode('utf-8')
+_INTERNAL_ERROR_PAGE = """
 <!DOCTYPE html>
 <html>
 <head>
@@ -879,41 +1119,58 @@ def internal_error(error):
     </div>
 </body>
 </html>
-    """, 500
+    """.encode('utf-8')
+
+@app.errorhandler(404)
+def not_found(error):
+    # A fresh Response per call - shared ones could be mutated by request hooks
+    return Response(_NOT_FOUND_PAGE, status=404, mimetype='text/html')
+
+@app.errorhandler(500)
+def internal_error(error):
+    return Response(_INTERNAL_ERROR_PAGE, status=500, mimetype='text/html')
 
 def cleanup_sessions():
-    """Background task to cleanup old sessions"""
-    while server_running:
-        try:
-            current_time = time.time()
-            sessions_to_remove = []
-            
-            for session_id, metadata in video_metadata.items():
-                if current_time - metadata.get('created', 0) > 3600:  # 1 hour
-                    sessions_to_remove.append(session_id)
-            
-            for session_id in sessions_to_remove:
-                if session_id in video_sessions:
+    """Background task that closes sessions as they pass SESSION_IDLE_TTL, sleeping while none are due"""
+    with _sessions_changed:
+        while server_running:
+            try:
+                current_time = time.time()
+                # Least recently used first, so stop at the first live session
+                while video_metadata:
+                    session_id, metadata = next(iter(video_metadata.items()))
+                    if current_time - metadata['last_used'] < SESSION_IDLE_TTL:
+                        break
+                    video_metadata.pop(session_id)
                     try:
-                        video_sessions[session_id].close()
+                        video_sessions.pop(session_id).close()
                     except:
                         pass
-                    del video_sessions[session_id]
-                if session_id in video_metadata:
-                    del video_metadata[session_id]
-                logger.info(f"Cleaned up old session: {session_id}")
-            
-            if sessions_to_remove:
-                gc.collect()
+                    logger.info(f"Cleaned up old session: {session_id}")
                 
-        except Exception as e:
-            logger.error(f"Session cleanup error: {e}")
-        
-        time.sleep(300)  # Run every 5 minutes
+            except Exception as e:
+                logger.error(f"Session cleanup error: {e}")
+            
+            # The front session expires first; with none, wait for store_video_session()
+            timeout = None
+            if video_metadata:
+                timeout = next(iter(video_metadata.values()))['last_used'] + SESSION_IDLE_TTL - time.time()
+            _sessions_changed.wait(timeout)
 
-# Start cleanup thread
-cleanup_thread = threading.Thread(target=cleanup_sessions, daemon=True)
-cleanup_thread.start()
+def reset_upstream_pools():
+    """Drop upstream connections inherited across fork so workers never share a TLS socket"""
+    UPSTREAM_SESSION.close()
+    with _sessions_lock:
+        for session_obj in video_sessions.values():
+            session_obj.close()
+
+def start_background_tasks():
+    """Start the session cleanup thread in the current process"""
+    threading.Thread(target=cleanup_sessions, daemon=True).start()
+
+# Start background threads - under gunicorn the post_fork hook starts them per worker
+if 'gunicorn' not in sys.modules:
+    start_background_tasks()
 
 def signal_handler(sig, frame):
     """Handle shutdown signals"""
@@ -930,16 +1187,8 @@ def signal_handler(sig, frame):
     
     sys.exit(0)
 
-# Register signal handlers
-signal.signal(signal.SIGINT, signal_handler)
-signal.signal(signal.SIGTERM, signal_handler)
-
-if __name__ == '__main__':
-    port = int(os.environ.get('PORT', 5000))
-    debug = os.environ.get('FLASK_ENV') == 'development'
-    
-    logger.info(f"Starting Isolated Fast Streaming Server on port {port}")
-    logger.info(f"Debug mode: {debug}")
-    logger.info("No default video URL - Users must provide video URLs")
-    
-    app.run(host='0.0.0.0', port=port, debug=debug, threaded=True)
+# Register signal handlers - gunicorn's master and workers install their own,
+# so only the local development server (main.py) needs these
+if 'gunicorn' not in sys.modules:
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
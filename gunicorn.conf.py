@@ -4,27 +4,70 @@ Optimized for video streaming with high concurrency
 """
 import os
 import multiprocessing
+import socket
+
+from gunicorn.glogging import Logger
+
+# Greenlet workers - patch sockets before the preloaded app imports requests
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gevent')
+if worker_class == "gevent":
+    from gevent import monkey
+    monkey.patch_all()
 
 # Server socket
 bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
-backlog = 2048
-
-# Worker processes
-workers = multiprocessing.cpu_count() * 2 + 1
-worker_class = "sync"
-worker_connections = 1000
+backlog = 8192  # Absorb connection bursts when a popular video is shared
+# Opt-in send buffer for client sockets (inherited from the listener). Unset or 0
+# leaves Linux send-buffer autotuning on, which suits most hosts: a fixed value
+# turns it off, the kernel doubles it, and every slow client can then pin that
+# much memory (x worker_connections per worker). The kernel also clamps it to
+# net.core.wmem_max - the 212992 default caps any value at ~416KB, below what
+# autotuning reaches - so raise wmem_max first when setting GUNICORN_SNDBUF
+# TCP_NODELAY is already set on the listener by gunicorn itself
+sndbuf = int(os.environ.get('GUNICORN_SNDBUF', 0))
+
+# Worker processes - greenlet workers never block on upstream reads, so one
+# per core is enough; thread/sync workers still need oversubscribing
+if worker_class == "gevent":
+    workers = multiprocessing.cpu_count()
+else:
+    workers = multiprocessing.cpu_count() * 2 + 1
+# Each open stream costs one greenlet (gevent) or one thread (gthread fallback)
+# instead of pinning a whole process
+threads = int(os.environ.get('GUNICORN_THREADS', 32))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 4000))
 timeout = 120
 keepalive = 5
 
-# Restart workers after this many requests, to prevent memory leaks
-max_requests = 1000
-max_requests_jitter = 50
+# Recycling a worker kills its open streams after graceful_timeout, and one
+# viewer may hold a single request for hours - so recycling is off by default
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 20
 
 # Logging
 accesslog = "-"
 errorlog = "-"
 loglevel = "info"
 access_log_format = '%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s" %(D)s'
+# Successful stream requests write one access line per this many (1 logs every request)
+access_log_sample = max(1, int(os.environ.get('ACCESS_LOG_SAMPLE', 100)))
+STREAM_PATH_PREFIXES = ('/video', '/fast', '/mx', '/proxy/')
+
+class StreamSamplingLogger(Logger):
+    """Access logger that samples successful streaming requests; players send many ranges per view"""
+
+    def __init__(self, cfg):
+        super().__init__(cfg)
+        self.stream_requests = 0
+
+    def access(self, resp, req, environ, request_time):
+        if resp.status_code < 400 and req.path.startswith(STREAM_PATH_PREFIXES):
+            self.stream_requests += 1
+            if self.stream_requests % access_log_sample:
+                return
+        super().access(resp, req, environ, request_time)
+
+logger_class = StreamSamplingLogger
 
 # Process naming
 proc_name = "isolated-video-streaming"
@@ -41,7 +84,7 @@ keyfile = None
 certfile = None
 
 # Performance tuning for video streaming
-preload_app = True
+preload_app = True  # Shared video state must exist before fork; post_fork resets inherited pools
 sendfile = True
 
 # Security
@@ -61,6 +104,7 @@ def on_starting(server):
     server.log.info("Starting Isolated Fast Video Streaming Server")
     server.log.info(f"Binding to {bind}")
     server.log.info(f"Workers: {workers}")
+    server.log.info(f"Worker class: {worker_class}")
 
 def on_reload(server):
     """Called to recycle workers during a reload via SIGHUP."""
@@ -77,6 +121,16 @@ def pre_fork(server, worker):
 def post_fork(server, worker):
     """Called just after a worker has been forked."""
     server.log.info(f"Worker {worker.pid} has been forked")
+    if sndbuf:
+        for listener in worker.sockets:
+            try:
+                listener.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+            except OSError as e:
+                server.log.warning(f"Could not set SO_SNDBUF on {listener}: {e}")
+    # Background threads are started per worker, never in the preloading master
+    from app import reset_upstream_pools, start_background_tasks
+    reset_upstream_pools()
+    start_background_tasks()
 
 def worker_abort(worker):
     """Called when a worker receives the SIGABRT signal."""
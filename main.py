@@ -1,4 +1,14 @@
-from app import app
+"""Local development entry point - production runs gunicorn --config gunicorn.conf.py main:app"""
+import os
+
+from app import app, logger
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=False)
\ No newline at end of file
+    port = int(os.environ.get('PORT', 5000))
+    debug = os.environ.get('FLASK_ENV') == 'development'
+    
+    logger.info(f"Starting Isolated Fast Streaming Server on port {port}")
+    logger.info(f"Debug mode: {debug}")
+    logger.info("No default video URL - Users must provide video URLs")
+    
+    app.run(host="0.0.0.0", port=port, debug=debug, threaded=True)
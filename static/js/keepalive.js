@@ -0,0 +1,15 @@
+// Keep-alive mechanism to prevent app from going offline
+setInterval(function() {
+    fetch('/keepalive', {method: 'GET'}).catch(function(error) {
+        console.log('Keep-alive ping failed:', error);
+    });
+}, 30000); // Ping every 30 seconds
+
+// Also ping when page becomes visible again
+document.addEventListener('visibilitychange', function() {
+    if (!document.hidden) {
+        fetch('/keepalive', {method: 'GET'}).catch(function(error) {
+            console.log('Visibility ping failed:', error);
+        });
+    }
+});
@@ -0,0 +1,252 @@
+"""
+Unit tests for the pure streaming helpers in app.py
+"""
+import gzip
+import io
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from requests.structures import CaseInsensitiveDict
+
+import app
+
+
+class FakeResponse:
+    """Just enough of a requests.Response for the header helpers"""
+
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = CaseInsensitiveDict(headers or {})
+
+
+class FakeSession:
+    """Records GETs and answers each with a canned response"""
+
+    def __init__(self, response):
+        self.response = response
+        self.requests = []
+
+    def get(self, url, headers=None, **kwargs):
+        self.requests.append(headers)
+        return self.response
+
+
+class OriginHandler(BaseHTTPRequestHandler):
+    """Keep-alive origin serving server.body in server.write_size writes,
+    server.write_delay apart, and counting the connections it accepts"""
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_GET(self):
+        body = self.server.body
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        for start in range(0, len(body), self.server.write_size):
+            self.wfile.write(body[start:start + self.server.write_size])
+            time.sleep(self.server.write_delay)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def origin():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), OriginHandler)
+    server.daemon_threads = True
+    server.connections = 0
+    server.body = b''
+    server.write_size = 64 * 1024
+    server.write_delay = 0
+    server.url = f'http://127.0.0.1:{server.server_port}/video.mp4'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_parse_range():
+    assert app.parse_range('bytes=0-99') == (0, 99)
+    assert app.parse_range('bytes=100-') == (100, None)
+    assert app.parse_range(' bytes=5-5 ') == (5, 5)
+    # Suffix, inverted, multi-part and missing ranges are not single ranges
+    assert app.parse_range('bytes=-500') == (None, None)
+    assert app.parse_range('bytes=9-1') == (None, None)
+    assert app.parse_range('bytes=0-1,5-9') == (None, None)
+    assert app.parse_range(None) == (None, None)
+
+
+def test_clamp_range_header_caps_open_and_large_ranges():
+    cap = app.MAX_SINGLE_RANGE
+    assert app.clamp_range_header('bytes=0-') == (f'bytes=0-{cap - 1}', 0, cap - 1)
+    assert app.clamp_range_header('bytes=1000-') == (f'bytes=1000-{1000 + cap - 1}', 1000, 1000 + cap - 1)
+    assert app.clamp_range_header(f'bytes=0-{cap * 4}') == (f'bytes=0-{cap - 1}', 0, cap - 1)
+
+
+def test_clamp_range_header_keeps_small_ranges():
+    assert app.clamp_range_header('bytes=100-199') == ('bytes=100-199', 100, 199)
+
+
+def test_clamp_range_header_forwards_other_ranges_untouched():
+    assert app.clamp_range_header('bytes=-500') == ('bytes=-500', None, None)
+    assert app.clamp_range_header('bytes=0-1,5-9') == ('bytes=0-1,5-9', None, None)
+    assert app.clamp_range_header(None) == (None, None, None)
+
+
+def test_synthesize_partial_caps_a_whole_body_answer():
+    resp_headers = {'Content-Length': '5000'}
+    status_code, byte_limit = app.synthesize_partial(FakeResponse(200), 0, 999, resp_headers)
+    assert (status_code, byte_limit) == (206, 1000)
+    assert resp_headers == {'Content-Length': '1000', 'Content-Range': 'bytes 0-999/5000'}
+
+
+def test_synthesize_partial_stops_at_the_end_of_the_body():
+    resp_headers = {'Content-Length': '500'}
+    status_code, byte_limit = app.synthesize_partial(FakeResponse(200), 0, 999, resp_headers)
+    assert (status_code, byte_limit) == (206, 500)
+    assert resp_headers == {'Content-Length': '500', 'Content-Range': 'bytes 0-499/500'}
+
+
+def test_synthesize_partial_passes_other_answers_through():
+    resp_headers = {'Content-Length': '100', 'Content-Range': 'bytes 0-99/5000'}
+    assert app.synthesize_partial(FakeResponse(206), 0, 99, resp_headers) == (206, None)
+    # Honouring a range that starts later would mean skipping bytes
+    assert app.synthesize_partial(FakeResponse(200), 10, 99, {'Content-Length': '5000'}) == (200, None)
+    # Without a length there is no total to report
+    assert app.synthesize_partial(FakeResponse(200), 0, 99, {}) == (200, None)
+    assert resp_headers == {'Content-Length': '100', 'Content-Range': 'bytes 0-99/5000'}
+
+
+def test_limit_stream():
+    assert list(app.limit_stream(iter([b'abc', b'def', b'ghi']), 5)) == [b'abc', b'de']
+    assert list(app.limit_stream(iter([b'abc']), 10)) == [b'abc']
+
+
+def test_read_into_buffer_flushes_the_short_tail_at_eof():
+    data = bytes(range(256)) * 1200
+    chunks = list(app.read_into_buffer(io.BytesIO(data), 128 * 1024))
+    assert [len(chunk) for chunk in chunks] == [131072, 131072, len(data) - 262144]
+    assert all(isinstance(chunk, bytes) for chunk in chunks)
+    assert b''.join(chunks) == data
+
+
+def test_read_into_buffer_ends_cleanly_on_a_chunk_boundary():
+    data = b'x' * (256 * 1024)
+    chunks = list(app.read_into_buffer(io.BytesIO(data), 128 * 1024))
+    assert [len(chunk) for chunk in chunks] == [131072, 131072]
+
+
+def test_read_into_buffer_empty_body():
+    assert list(app.read_into_buffer(io.BytesIO(b''), 128 * 1024)) == []
+
+
+def test_streamed_bodies_reuse_one_upstream_connection(origin):
+    origin.body = bytes(range(256)) * 1200
+    with app.new_upstream_session() as session_obj:
+        # Generator path, closed by stream_video() once the body is done
+        response = session_obj.get(origin.url, stream=True, timeout=5)
+        assert b''.join(app.read_into_buffer(response.raw, 128 * 1024)) == origin.body
+        response.close()
+        # File wrapper path, closed by the WSGI server
+        response = session_obj.get(origin.url, stream=True, timeout=5)
+        body = app.BufferedBody(response.raw, 128 * 1024)
+        assert b''.join(iter(lambda: body.read(128 * 1024), b'')) == origin.body
+        body.close()
+    assert origin.connections == 1
+
+
+def test_read_into_buffer_coalesces_a_throttled_origin(origin):
+    # About 16MB/s in 16KB writes: each 64KB read outlasts STREAM_FLUSH_INTERVAL,
+    # but upstream never goes quiet for that long
+    origin.body = bytes(range(256)) * 4096
+    origin.write_size = 16 * 1024
+    origin.write_delay = 0.001
+    with app.new_upstream_session() as session_obj:
+        response = session_obj.get(origin.url, stream=True, timeout=5)
+        chunks = list(app.read_into_buffer(response.raw, 256 * 1024))
+        response.close()
+    assert b''.join(chunks) == origin.body
+    assert len(chunks) <= 6
+    assert max(len(chunk) for chunk in chunks) == 256 * 1024
+
+
+def test_read_into_buffer_flushes_when_upstream_stalls(origin):
+    # Reads block for a full STREAM_READ_SIZE, so stalls split chunks at that granularity
+    origin.body = b'x' * (2 * app.STREAM_READ_SIZE)
+    origin.write_size = app.STREAM_READ_SIZE
+    origin.write_delay = 0.1
+    with app.new_upstream_session() as session_obj:
+        response = session_obj.get(origin.url, stream=True, timeout=5)
+        chunks = list(app.read_into_buffer(response.raw, 256 * 1024))
+        response.close()
+    assert [len(chunk) for chunk in chunks] == [app.STREAM_READ_SIZE, app.STREAM_READ_SIZE]
+
+
+def test_read_into_buffer_measures_every_chunk_of_a_throttled_origin(origin, monkeypatch):
+    monkeypatch.setattr(app, '_bw_ewma', 0.0)
+    monkeypatch.setattr(app, '_bw_samples', 0.0)
+    origin.body = bytes(range(256)) * 4096
+    origin.write_size = 16 * 1024
+    origin.write_delay = 0.001
+    with app.new_upstream_session() as session_obj:
+        response = session_obj.get(origin.url, stream=True, timeout=5)
+        for _ in app.read_into_buffer(response.raw, 256 * 1024):
+            pass
+        response.close()
+    assert app._bw_samples == pytest.approx(len(origin.body) / app.NETWORK_SAMPLE_BYTES)
+    # A real measurement of the ~16MB/s the origin is paced at
+    assert 1000 < app._bw_ewma < 64 * 1024
+
+
+def test_record_throughput_weights_samples_by_size(monkeypatch):
+    monkeypatch.setattr(app, '_bw_ewma', 1000.0)
+    monkeypatch.setattr(app, '_bw_samples', 0.0)
+    # One full sample at 2000 KB/s moves the average by NETWORK_EWMA_ALPHA
+    app.record_throughput(app.NETWORK_SAMPLE_BYTES, app.NETWORK_SAMPLE_BYTES / 1024 / 2000)
+    full = app._bw_ewma
+    assert full == pytest.approx(1000 + app.NETWORK_EWMA_ALPHA * 1000)
+    # Two half samples at the same rate land in the same place
+    monkeypatch.setattr(app, '_bw_ewma', 1000.0)
+    for _ in range(2):
+        app.record_throughput(app.NETWORK_SAMPLE_BYTES // 2, app.NETWORK_SAMPLE_BYTES / 2048 / 2000)
+    assert app._bw_ewma == pytest.approx(full)
+    assert app._bw_samples == pytest.approx(2)
+
+
+def test_head_via_get_reports_the_whole_resource():
+    session_obj = FakeSession(FakeResponse(206, {'Content-Length': '1', 'Content-Range': 'bytes 0-0/5000'}))
+    response = app.head_via_get(session_obj, 'https://example.com/v.mp4', {'Referer': 'r'}, 5)
+    assert session_obj.requests == [{'Referer': 'r', 'Range': 'bytes=0-0'}]
+    assert response.status_code == 200
+    assert response.headers['Content-Length'] == '5000'
+    assert 'Content-Range' not in response.headers
+
+
+def test_head_via_get_keeps_the_client_range():
+    session_obj = FakeSession(FakeResponse(206, {'Content-Length': '10', 'Content-Range': 'bytes 10-19/5000'}))
+    response = app.head_via_get(session_obj, 'https://example.com/v.mp4', {'Range': 'bytes=10-19'}, 5)
+    assert session_obj.requests == [{'Range': 'bytes=10-19'}]
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == 'bytes 10-19/5000'
+
+
+def test_adaptive_chunk_size_waits_for_real_samples(monkeypatch):
+    monkeypatch.setattr(app, '_bw_ewma', 100.0)
+    monkeypatch.setattr(app, '_bw_samples', app.NETWORK_MIN_SAMPLES - 1)
+    assert app.adaptive_chunk_size(app.FAST_CHUNK_SIZE) == app.FAST_CHUNK_SIZE
+    monkeypatch.setattr(app, '_bw_samples', app.NETWORK_MIN_SAMPLES)
+    assert app.adaptive_chunk_size(app.FAST_CHUNK_SIZE) == app.MIN_CHUNK_SIZE
+
+
+def test_render_page_gzip_matches_the_plain_page():
+    context = dict(active_session='isolated_1_0', cache_buster=1, sessions_count=0,
+                   current_url='https://example.com/v.mp4', now='12:00:00')
+    with app.app.test_request_context('/', headers={'Accept-Encoding': 'gzip, deflate'}):
+        response = app.render_page(app._TEST_ISOLATION_TMPL, **context)
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(response.get_data()).decode('utf-8') == app._TEST_ISOLATION_TMPL.render(**context)